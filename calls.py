@@ -1,19 +1,24 @@
-import operator
-import inspect
-from abc import ABC
+from collections import deque, ChainMap
 from math import sqrt
-from functools import reduce
-from copy import copy, deepcopy
+from copy import deepcopy
+from sys import intern
 
 
 def pairs(it):
-    return ((it[i], it[i+1]) for i in range(0, len(it), 2))
+    if len(it) % 2:
+        # The error the old item-by-item version raised
+        # when it ran off the end of an odd-length input
+        raise IndexError("tuple index out of range")
+    return zip(it[::2], it[1::2])
 
 
 # Represents a user provided string.
 # Making it a subclass means I can prevent
 # them being looked up repeatedly.
 class StringVar(object):
+    # No __dict__, we make a lot of these
+    __slots__ = ("value",)
+
     def __init__(self, s):
         self.value = s
 
@@ -24,6 +29,8 @@ class StringVar(object):
         return len(self.value)
 
     def __eq__(self, other):
+        if not isinstance(other, StringVar):
+            return NotImplemented
         return self.value == other.value
 
     def __hash__(self):
@@ -38,6 +45,11 @@ class StringVar(object):
         return StringVar(self.value + other.value)
 
 
+# One shared StringVar per char, mostly for inttochar
+# which would otherwise allocate a fresh one per call.
+_char_strings = tuple(StringVar(chr(i)) for i in range(256))
+
+
 def lookup_var(scope, global_scope, arg, current_call):
     # Note: current_call is only here for the error msg
 
@@ -50,52 +62,151 @@ def lookup_var(scope, global_scope, arg, current_call):
     if arg.startswith("'"):
         return False, arg[1:]
 
-    try:
-        # Integer argument
-        return False, int(arg)
-    except ValueError:
-        # Must be the name of some symbol
-
-        # Whether to expand a list into flat arguments
-        # (print *ls) => (print ls[0] ls[1] ...)
-        expand = False
-
-        # Symbol preceeded with * is expanded
-        # "*" on its own is not
-        if arg.startswith("*") and len(arg) > 1:
-            arg = arg[1:]
-            expand = True
-
-        # Local scope first
-        if arg in scope:
-            arg = scope[arg]
-        elif arg in global_scope:
-            arg = global_scope[arg]
+    # Only try int() on things that could be one.
+    # Almost every symbol is a name, and int() raising
+    # ValueError for each of those is expensive.
+    first = arg[0]
+    if first.isdigit() or first == "-" or first == "+":
+        try:
+            # Integer argument
+            return False, int(arg)
+        except ValueError:
+            # "-" on its own etc., treat as a name
+            pass
+
+    # Must be the name of some symbol
+
+    # Whether to expand a list into flat arguments
+    # (print *ls) => (print ls[0] ls[1] ...)
+    expand = False
+
+    # Symbol preceeded with * is expanded
+    # "*" on its own is not
+    if arg.startswith("*") and len(arg) > 1:
+        arg = arg[1:]
+        expand = True
+
+    # Local scope first
+    if arg in scope:
+        arg = scope[arg]
+    elif arg in global_scope:
+        arg = global_scope[arg]
+    else:
+        msg = "Reference to unknown symbol \"{}\" in \"{}\"."
+        raise RuntimeError(msg.format(arg, current_call))
+
+    return expand, arg
+
+
+# Argument kinds as found by classify_arg
+ARG_CONST, ARG_SYMBOL, ARG_EXPAND = range(3)
+
+# The same small numbers appear all over a program.
+# One shared classified tuple per literal value.
+_int_literals = {}
+
+
+def classify_arg(arg):
+    """ Work out once what kind of argument this is.
+        Executing the same call again (fn bodies mostly)
+        can then skip re-parsing the same strings, and
+        skip the ValueError raise that int() does for
+        every name.
+        Returns (kind, value) where value is the constant
+        itself, or the name to look up in a scope.
+    """
+    # Literal strings and anything already resolved
+    if isinstance(arg, StringVar) or not isinstance(arg, str):
+        return ARG_CONST, arg
+
+    # ' escape char, don't evaluate
+    if arg.startswith("'"):
+        return ARG_CONST, arg[1:]
+
+    # Same first-char guard as lookup_var, no point
+    # paying for int()'s ValueError on every name.
+    first = arg[0]
+    if first.isdigit() or first == "-" or first == "+":
+        try:
+            # Integer argument
+            value = int(arg)
+        except ValueError:
+            pass
         else:
-            msg = "Reference to unknown symbol \"{}\" in \"{}\"."
-            raise RuntimeError(msg.format(arg, current_call))
+            entry = _int_literals.get(value)
+            if entry is None:
+                entry = _int_literals[value] = (ARG_CONST, value)
+            return entry
+
+    # Must be the name of some symbol.
+    # Names are interned so that the scope dict
+    # lookups can compare by identity.
+
+    # Symbol preceeded with * is expanded
+    # "*" on its own is not
+    if arg.startswith("*") and len(arg) > 1:
+        return ARG_EXPAND, intern(arg[1:])
+
+    return ARG_SYMBOL, intern(arg)
+
 
-        return expand, arg
+# All the Calls that user code can refer to by name.
+# Filled in by the @builtin decorator as each class
+# is defined, rather than walking __subclasses__ on
+# import like we used to. That also means abstract
+# bases don't need filtering out by their empty name.
+builtin_calls = {}
 
-    # Something that was already evaluated
-    return False, arg
 
+def builtin(cls):
+    builtin_calls[cls.name] = cls
+    return cls
+
+
+class Call(object):
+    # All the mutable state a call carries. No __dict__
+    # per instance, a parsed program is mostly Calls.
+    __slots__ = ("args", "resolved_symbols", "prepared",
+                 "classified_args", "apply_fn")
 
-class Call(ABC):
     # Empty name means user code won't be calling this fn
     name = ""
     # Whether args must be validated earlier
     validate_on_resolve = False
+    # Set on calls that override can_prepare to wait for
+    # certain args. When False the execute loop can prepare
+    # straight away without asking per argument.
+    delayed_prepare = False
 
     def __init__(self, *args):
         self.args = args
         self.resolved_symbols = False
         self.prepared = False
+        # Filled in on first resolve, args never change
+        # so this survives _reset.
+        self.classified_args = None
+        # Bind the right override once. Looking up
+        # call.apply makes a new bound method every time,
+        # which adds up for calls that run repeatedly.
+        self.apply_fn = self.apply
 
     def can_prepare(self, args, arg_idx):
         # Have we executed enough args to be able to prepare?
         return True
 
+    def _reset(self):
+        """ Clear the run-once flags on this call and every
+            call below it, so that the tree can be executed
+            again. Iterative because fn bodies can nest deeper
+            than Python's recursion limit.
+        """
+        worklist = deque((self,))
+        while worklist:
+            c = worklist.pop()
+            c.resolved_symbols = False
+            c.prepared = False
+            worklist.extend(a for a in c.args if isinstance(a, Call))
+
     def sort_args(self, args):
         # Here we would re-order args to put
         # those required for prepare first
@@ -118,18 +229,22 @@ class Call(ABC):
             already, and we can get the true
             number of arguments.
         """
-        insert = "" if self.exact else "at least "
-        pluralise = "s" if self.num_args != 1 else ""
-
         if (self.exact and len(final_args) != self.num_args) or \
            (not self.exact and len(final_args) < self.num_args):
+            # Only build the message parts once we know
+            # we're raising. This runs on every call, the
+            # repr of self in particular is not cheap.
+            insert = "" if self.exact else "at least "
+            pluralise = "s" if self.num_args != 1 else ""
             err = "Expected {}{} argument{} for function \"{}\", got {}."
             raise RuntimeError(err.format(
                                 insert, self.num_args,
                                 pluralise, self.name, len(final_args)))
 
 
+@builtin
 class NotCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 1
     name = "not"
@@ -138,16 +253,26 @@ class NotCall(Call):
         return not boolean
 
 
+@builtin
 class EqualCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 2
     name = "eq"
 
     def apply(self, scope, global_scope, *args):
-        return len(set(args)) == 1
+        # Stop at the first mismatch, rather than
+        # hashing everything into a set.
+        first = args[0]
+        for arg in args[1:]:
+            if arg != first:
+                return False
+        return True
 
 
+@builtin
 class LessThanCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 2
     name = "<"
@@ -158,7 +283,9 @@ class LessThanCall(Call):
 
 # NoneCall and TrueCall being any number of args
 # means you can use them to ignore return values.
+@builtin
 class NoneCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 0
     name = "none"
@@ -167,7 +294,9 @@ class NoneCall(Call):
         return None
 
 
+@builtin
 class TrueCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 0
     name = "true"
@@ -176,7 +305,9 @@ class TrueCall(Call):
         return True
 
 
+@builtin
 class CharToIntCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 1
     name = "chartoint"
@@ -185,20 +316,27 @@ class CharToIntCall(Call):
         return ord(c.value)
 
 
+@builtin
 class IntToCharCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 1
     name = "inttochar"
 
     def apply(self, scope, global_scope, i):
+        if 0 <= i < 256:
+            return _char_strings[i]
         return StringVar(chr(i))
 
 
+@builtin
 class CondCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 2
     name = "cond"
     validate_on_resolve = True
+    delayed_prepare = True
 
     def can_prepare(self, args, arg_idx):
         # Executed first half
@@ -236,6 +374,9 @@ class CondCall(Call):
         # matched pairs of name-value, followed by
         # a single body.
         num_args = len(final_args)
+        if num_args >= 2 and not num_args % 2:
+            return
+
         expect = "(cond <condition> <action> ...)"
         if num_args < 2:
             raise RuntimeError(
@@ -247,11 +388,14 @@ Expected {}".format(self, expect))
 Expected {}".format(self, expect))
 
 
+@builtin
 class IfCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 2
     name = "if"
     validate_on_resolve = True
+    delayed_prepare = True
 
     def can_prepare(self, args, arg_idx):
         return arg_idx == 0
@@ -275,7 +419,9 @@ class IfCall(Call):
         # Otherwise None because nothing was done
 
 
+@builtin
 class ModulusCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 2
     name = "%"
@@ -284,16 +430,28 @@ class ModulusCall(Call):
         return a % b
 
 
+@builtin
 class PlusCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 1
     name = "+"
 
     def apply(self, scope, global_scope, *args):
-        return reduce(operator.add, args)
+        # Two args is by far the most common case.
+        # (can't use sum() here, strings also get added)
+        if len(args) == 2:
+            return args[0] + args[1]
+
+        total = args[0]
+        for arg in args[1:]:
+            total += arg
+        return total
 
 
+@builtin
 class MinusCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 1
     name = "-"
@@ -301,34 +459,50 @@ class MinusCall(Call):
     def apply(self, scope, global_scope, *args):
         if len(args) == 1:
             return -args[0]
-        return reduce(operator.sub, args)
+        if len(args) == 2:
+            return args[0] - args[1]
+
+        total = args[0]
+        for arg in args[1:]:
+            total -= arg
+        return total
 
 
+@builtin
 class SquareRootCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 1
     name = "sqrt"
 
-    def apply(self, scope, gobal_scope, a):
-        return sqrt(a)
+    # sqrt bound as a default so it's a local load,
+    # not a module global lookup per call
+    def apply(self, scope, gobal_scope, a, _sqrt=sqrt):
+        return _sqrt(a)
 
 
+@builtin
 class PrintCall(Call):
+    __slots__ = ()
     exact = False
     num_args = 0
     name = "print"
 
     def apply(self, scope, global_scope, *args):
-        print(*map(
-            lambda v: v.value if isinstance(v, StringVar) else v,
-            args))
+        # Inline comprehension, map with a lambda means
+        # a Python function call per printed value.
+        print(*[v.value if isinstance(v, StringVar) else v
+                for v in args])
 
 
+@builtin
 class LetCall(Call):
+    __slots__ = ()
     exact = True
     num_args = 3
     name = "let"
     validate_on_resolve = True
+    delayed_prepare = True
 
     def can_prepare(self, args, arg_idx):
         # -1 for the body, executed last value
@@ -339,7 +513,10 @@ class LetCall(Call):
         # Inner scope, don't modify outer
         # E.g. (let 'x 1 (let 'y 2 (+ 1 y)) (+ x y))
         # Should be an error, y is only in the inner scope
-        scope = copy(scope)
+        # A new layer over the old scope, not a copy of it.
+        # The write below goes to the new empty dict and
+        # lookups fall through to the outer scope.
+        scope = ChainMap({}, scope)
 
         for k, v in pairs(args[:-1]):
             if isinstance(k, StringVar):
@@ -354,6 +531,9 @@ class LetCall(Call):
         # matched pairs of name-value, followed by
         # a single body.
         num_args = len(final_args)
+        if num_args >= 3 and num_args % 2:
+            return
+
         expect = "(let <name> <value> ... (body))"
         if num_args < 3:
             raise RuntimeError(
@@ -369,7 +549,9 @@ Expected {}".format(self, expect))
         return args[-1]
 
 
+@builtin
 class LenCall(Call):
+    __slots__ = ()
     name = "len"
     exact = True
     num_args = 1
@@ -378,7 +560,9 @@ class LenCall(Call):
         return len(ls)
 
 
+@builtin
 class NthCall(Call):
+    __slots__ = ()
     name = "nth"
     exact = True
     num_args = 2
@@ -387,36 +571,50 @@ class NthCall(Call):
         return ls[idx]
 
 
+@builtin
 class FlattenCall(Call):
+    __slots__ = ()
     name = "flatten"
     exact = True
     num_args = 1
 
     def apply(self, scope, global_scope, ls):
-        flat = []
+        # StringVar is allowed at the top level, iterating
+        # one is how flatten gives you a string's chars.
+        if not isinstance(ls, (list, tuple, StringVar)):
+            raise RuntimeError(
+                "Flatten \"{}\" not called with a list.".format(self))
 
-        def _flatten(_ls):
-            try:
-                for l in _ls:
-                    if isinstance(l, StringVar):
-                        flat.append(l)
-                    else:
-                        try:
-                            iter(l)
-                            _flatten(l)
-                        except TypeError:
-                            flat.append(l)
-            except TypeError:
-                raise RuntimeError(
-                    "Flatten \"{}\" not called with a list.".format(self))
-
-        _flatten(ls)
+        # A stack of iterators rather than recursion.
+        # No depth limit, and no more iter()/TypeError
+        # probing of every element.
+        flat = []
+        stack = deque((iter(ls),))
+        while stack:
+            for l in stack[-1]:
+                if isinstance(l, (list, tuple)):
+                    stack.append(iter(l))
+                    break
+                # Note that nested StringVars stay whole
+                flat.append(l)
+            else:
+                stack.pop()
 
         # Tuple for consistency when printing
         return tuple(flat)
 
 
 class BaseUserCall(Call):
+    # The body (if any) this particular call took
+    # from the pool, so apply can give it back.
+    __slots__ = ("_pool_body",)
+
+    delayed_prepare = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._pool_body = None
+
     def can_prepare(self, args, arg_idx):
         # About to execute the body
         return arg_idx >= (len(args)-1)
@@ -431,37 +629,136 @@ class BaseUserCall(Call):
         # Add lambda captured vars
         scope.update(self.captures)
 
-        # Make star empty as default in case they only
-        # call with positional args. It must still be defined.
-        if self.variadic:
-            scope["*"] = ()
-
-        for idx in range(len(self.arg_names)):
-            if self.arg_names[idx] == "*":
-                # Tuple just to keep printing consistent
-                scope["*"] = tuple(args[idx:])
-                break
-            try:
-                scope[self.arg_names[idx]] = args[idx]
-            except IndexError:
-                # Dummy since body hasn't been added yet
-                args.append(None)
-                # We validated that MaybeFunctionCall had the right args.
-                # Now check that the actual call we got is correct.
-                self.validate_args(args)
-
-        # Now we want the body to run
-        # deepcopy so that prepared flags aren't set
-        # next time we run this body
-        args.append(deepcopy(self.body))
+        # Where "*" sits in arg_names is fixed per function,
+        # so it was worked out once at defun time rather than
+        # searching for it on every call.
+        names = self.arg_names
+        star_idx = self.star_idx
+        bound = star_idx if star_idx >= 0 else len(names)
+
+        if len(args) < bound:
+            # Dummy since body hasn't been added yet
+            args.append(None)
+            # We validated that MaybeFunctionCall had the right args.
+            # Now check that the actual call we got is correct.
+            self.validate_args(args)
+
+        if star_idx >= 0:
+            # Tuple just to keep printing consistent.
+            # Empty if they only passed positional args,
+            # it must still be defined.
+            scope["*"] = tuple(args[star_idx:])
+
+        for idx in range(bound):
+            scope[names[idx]] = args[idx]
+
+        # Now we want the body to run.
+        # Running a body sets the run-once flags throughout it,
+        # so each call needs a tree with those flags clear.
+        # Clearing the flags on a pooled copy is much cheaper
+        # than the deepcopy per call that we used to do.
+        # A pool (rather than one spare) because recursion means
+        # several bodies can be in flight at the same time.
+        if isinstance(self.body, Call):
+            pool = self._body_pool
+            body = pool.pop() if pool else deepcopy(self.body)
+            body._reset()
+            self._pool_body = body
+        else:
+            # A body like (defun 'get_foo foo) has nothing to reset
+            body = self.body
+        args.append(body)
         return args, scope
 
     def apply(self, scope, global_scope, *args):
+        if self._pool_body is not None:
+            self._body_pool.append(self._pool_body)
+            self._pool_body = None
         # The result of the fn body
         return args[-1]
 
 
+# Calls that always give the same result for the same
+# arguments, so are safe to evaluate ahead of time.
+_pure_calls = (NotCall, EqualCall, LessThanCall, ModulusCall,
+               PlusCall, MinusCall, SquareRootCall)
+
+
+def _can_splice(call):
+    """ A nested + can only be spliced into its parent if
+        we know at defun time how many arguments it will
+        really get. A *name expands to any number of values
+        at run time, maybe none, in which case the nested +
+        must still be there to raise for having no
+        arguments. Same for a literal (+), which always
+        raises. """
+    if not call.args:
+        return False
+    for arg in call.args:
+        if not isinstance(arg, Call) and \
+                classify_arg(arg)[0] == ARG_EXPAND:
+            return False
+    return True
+
+
+def fold_constants(call):
+    """ Replace pure calls whose arguments are all number
+        literals with their result, e.g. (+ 1 2) => 3.
+        We only bother for fn bodies, they are the one
+        kind of tree that gets executed more than once.
+        Anything that can't be folded safely is left
+        alone, including calls that would raise, so that
+        errors still happen at run time as before.
+    """
+    if not isinstance(call, Call):
+        return call
+
+    args = [fold_constants(arg) for arg in call.args]
+
+    if isinstance(call, PlusCall):
+        # + is associative (also over string concat) so
+        # nested adds can be spliced into their parent:
+        # (+ a (+ b c)) => (+ a b c)
+        # One node and one frame push fewer per call.
+        # - is not associative, leave it alone.
+        flat = []
+        for arg in args:
+            if isinstance(arg, PlusCall) and _can_splice(arg):
+                flat.extend(arg.args)
+            else:
+                flat.append(arg)
+        args = flat
+
+    if isinstance(call, _pure_calls):
+        values = []
+        for arg in args:
+            if isinstance(arg, Call):
+                break
+            kind, value = classify_arg(arg)
+            if kind != ARG_CONST or not isinstance(value, (int, float)):
+                break
+            values.append(value)
+        else:
+            try:
+                call.validate_args(values)
+                return call.apply(None, None, *values)
+            except Exception:
+                # Bad arg counts, sqrt of a negative etc.
+                # should still be reported when (if) the
+                # call actually runs.
+                pass
+
+    if len(args) != len(call.args) or \
+            any(a is not b for a, b in zip(args, call.args)):
+        # Some args were folded or spliced, remake with those
+        return type(call)(*args)
+    return call
+
+
+@builtin
 class DefineFunctionCall(Call):
+    __slots__ = ("body", "captures", "variadic")
+
     exact = False
     num_args = 2
     name = "defun"
@@ -469,7 +766,8 @@ class DefineFunctionCall(Call):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self.body = None
+        # Note that self.body is only set by prepare,
+        # which always runs before apply reads it.
 
         # Variables captured from the local scope
         # as the fn is defined. This will only be filled
@@ -495,7 +793,7 @@ class DefineFunctionCall(Call):
         it in the defun call until it actually gets
         executed.
         """
-        self.body = args.pop()
+        self.body = fold_constants(args.pop())
         return args, scope
 
     def apply(self, scope, global_scope, *args):
@@ -519,8 +817,15 @@ class DefineFunctionCall(Call):
                 "num_args": len(args)-1 if self.variadic else len(args),
                 "arg_names": args,
                 "variadic": self.variadic,
+                # "*" must be the last parameter, found
+                # here once instead of on every call
+                "star_idx": len(args)-1 if self.variadic else -1,
                 "body": self.body,
                 "captures": self.captures,
+                # Bodies free for reuse, one pool per function
+                "_body_pool": [],
+                # Keep generated classes __dict__-free too
+                "__slots__": (),
             }
         )
 
@@ -528,7 +833,9 @@ class DefineFunctionCall(Call):
         return global_scope[name]
 
 
+@builtin
 class LambdaFunctionCall(DefineFunctionCall):
+    __slots__ = ()
     name = "lambda"
 
     def apply(self, scope, global_scope, *args):
@@ -556,8 +863,13 @@ class MaybeFunctionCall(Call):
         (f) and check that it exists when
         we come to run it.
     """
+    # name is an instance attribute here, unlike
+    # every other Call where it's on the class
+    __slots__ = ("name",)
+
     num_args = 1
     exact = False
+    delayed_prepare = True
 
     def __init__(self, *args):
         # Name is just for printing
@@ -585,10 +897,13 @@ class MaybeFunctionCall(Call):
         # just use the value directly.
         real_fn = args[0]
 
+        # isinstance(x, type) is what inspect.isclass does,
+        # minus the function call. This runs for every user
+        # function call so that matters.
         # Check if it's a class first otherwise we get:
         # TypeError: cannot create weak reference to '<bla>' object
         # For anything that isn't a class type.
-        if not inspect.isclass(real_fn) or not issubclass(real_fn, Call):
+        if not isinstance(real_fn, type) or not issubclass(real_fn, Call):
             _, real_fn = lookup_var(scope, global_scope,
                                     real_fn, self)
             if isinstance(real_fn, StringVar):
@@ -598,7 +913,7 @@ class MaybeFunctionCall(Call):
         args = args[1:]
 
         # Check that a lookup did return a call type
-        if not inspect.isclass(real_fn) or not issubclass(real_fn, Call):
+        if not isinstance(real_fn, type) or not issubclass(real_fn, Call):
             msg = "\"{}\" is not a function, it is {} ({}). (in \"{}\")"
             raise RuntimeError(msg.format(
                 self.name, type(real_fn), real_fn, self))
@@ -616,13 +931,3 @@ class MaybeFunctionCall(Call):
         return args[-1]
 
 
-def subclasses(cls):
-    classes = set()
-    for c in cls.__subclasses__():
-        classes.add(c)
-        classes.update(subclasses(c))
-
-    return classes
-
-
-builtin_calls = {v.name: v for v in subclasses(Call)}
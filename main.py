@@ -1,26 +1,43 @@
+import os
 import string
 import re
 import argparse
-from copy import copy
+from collections import ChainMap
+from functools import lru_cache
 from calls import builtin_calls, StringVar
-from calls import Call, MaybeFunctionCall, lookup_var
+from calls import Call, MaybeFunctionCall
+from calls import classify_arg, ARG_CONST, ARG_EXPAND
 
 
 class ParsingError(Exception):
     pass
 
 
+# Contents of imported files, keyed by (path, mtime).
+# Importing the same library many times then only reads
+# it from disk once, but still executes it each time
+# (it may print, or define against a changed scope).
+_import_sources = {}
+
+
 # This call is here to avoid circular import of run_source_inner
 class ImportCall(Call):
+    __slots__ = ()
+
     name = "import"
     exact = True
     num_args = 1
     validate_on_resolve = True
 
     def prepare(self, scope, global_scope, args):
-        with open(args[0].value, 'r') as f:
-            _, global_scope = run_source_inner(
-                f.read(), global_scope=global_scope)
+        path = args[0].value
+        key = (path, os.stat(path).st_mtime_ns)
+        source = _import_sources.get(key)
+        if source is None:
+            with open(path, 'r') as f:
+                source = _import_sources[key] = f.read()
+        _, global_scope = run_source_inner(
+            source, global_scope=global_scope)
         return (), scope
 
     def apply(self, scope, global_scope, *args):
@@ -50,18 +67,55 @@ def execute(call, scope, global_scope):
     Which means let, cond, if, user functions etc.
     This new function does help some at least.
     """
-    stack = [(None, None, None, None)]
+    # One stack per frame field rather than a stack of
+    # tuples. Pushing doesn't pack a tuple and popping
+    # doesn't unpack one.
+    arg_stack = []
+    idx_stack = []
+    call_stack = []
+    scope_stack = []
     arg_idx = 0
 
+    # These are used for every argument of every call,
+    # so bind them once instead of looking them up
+    # on each pass round the loop.
+    push_args = arg_stack.append
+    push_idx = idx_stack.append
+    push_call = call_stack.append
+    push_scope = scope_stack.append
+    pop_args = arg_stack.pop
+    pop_idx = idx_stack.pop
+    pop_call = call_stack.pop
+    pop_scope = scope_stack.pop
+    _isinstance = isinstance
+    _Call = Call
+
     while True:
         if not call.resolved_symbols:
+            kinds = call.classified_args
+            if kinds is None:
+                kinds = [classify_arg(arg) for arg in call.args]
+                call.classified_args = kinds
+
             sym_args = []
-            for arg in call.args:
-                expand, arg = lookup_var(scope, global_scope, arg, call)
-                if expand:
-                    sym_args.extend(arg)
-                else:
+            for kind, arg in kinds:
+                if kind == ARG_CONST:
                     sym_args.append(arg)
+                    continue
+
+                # Local scope first
+                if arg in scope:
+                    value = scope[arg]
+                elif arg in global_scope:
+                    value = global_scope[arg]
+                else:
+                    msg = "Reference to unknown symbol \"{}\" in \"{}\"."
+                    raise RuntimeError(msg.format(arg, call))
+
+                if kind == ARG_EXPAND:
+                    sym_args.extend(value)
+                else:
+                    sym_args.append(value)
 
             # Note that argument sorting is *after* resolve/expansion
             sym_args = call.sort_args(sym_args)
@@ -79,7 +133,9 @@ def execute(call, scope, global_scope):
         # e.g. fn f with no args (f) after prepare will have
         # the body as an "argument", which we want to execute.
         # Hence the index of -1
-        if call.can_prepare(sym_args, -1) and not call.prepared:
+        if not call.prepared and \
+                (not call.delayed_prepare or
+                 call.can_prepare(sym_args, -1)):
             sym_args, scope = call.prepare(scope, global_scope, sym_args)
             # Prepare can remove args
             num_args = len(sym_args)
@@ -87,8 +143,11 @@ def execute(call, scope, global_scope):
 
         while arg_idx < num_args:
             arg = sym_args[arg_idx]
-            if isinstance(arg, Call):
-                stack.append((sym_args, arg_idx, call, scope))
+            if _isinstance(arg, _Call):
+                push_args(sym_args)
+                push_idx(arg_idx)
+                push_call(call)
+                push_scope(scope)
                 arg_idx = 0
                 call = arg
                 break
@@ -96,7 +155,8 @@ def execute(call, scope, global_scope):
             # See if we have enough to prepare.
             # Note that can_prepare wants the idx
             # of the arg we just executed.
-            if call.can_prepare(sym_args, arg_idx) and not call.prepared:
+            if not call.prepared and \
+                    call.can_prepare(sym_args, arg_idx):
                 sym_args, scope = call.prepare(scope, global_scope, sym_args)
                 # Prepare can add/remove args
                 num_args = len(sym_args)
@@ -113,23 +173,25 @@ def execute(call, scope, global_scope):
                 call.validate_args(sym_args)
 
             # Final run
-            result = call.apply(scope, global_scope, *sym_args)
+            result = call.apply_fn(scope, global_scope, *sym_args)
 
-            # Go back to parent
-            sym_args, arg_idx, call, scope = stack.pop()
-
-            if not stack:
-                # If we just popped the initial dummy stack
+            if not call_stack:
+                # Nothing left to go back to,
                 # the program has finished.
                 return result
-            else:
-                # Otherwise replace the arg and move to the next one
-                sym_args[arg_idx] = result
 
-                # I'm not going to inc arg_idx here, because we'd
-                # have to check whether we can prepare again.
-                # Just let the while check the same idx again, it'll
-                # see that it's not a call anyway.
+            # Otherwise go back to the parent and replace
+            # the arg with its result
+            sym_args = pop_args()
+            arg_idx = pop_idx()
+            call = pop_call()
+            scope = pop_scope()
+            sym_args[arg_idx] = result
+
+            # I'm not going to inc arg_idx here, because we'd
+            # have to check whether we can prepare again.
+            # Just let the while check the same idx again, it'll
+            # see that it's not a call anyway.
 
 
 # For tests to check number of calls
@@ -137,32 +199,51 @@ execute.count = 0
 
 
 def make_call(fn_name, args, global_scope):
-    try:
-        return global_scope[fn_name](*args)
-    except KeyError:
+    # get rather than try/except, a miss is common
+    # (any call to a user fn defined later) and
+    # raising is much more expensive than a None check.
+    call_type = global_scope.get(fn_name)
+    if call_type is None:
         # Maybe this is a user func defined later
         return MaybeFunctionCall(fn_name, *args)
+    return call_type(*args)
 
 
-def get_symbol(src, idx):
-    is_string = src[idx] == "\""
-    if is_string:
-        delimiters = ["\""]
-        idx += 1
-    else:
-        delimiters = ["(", ")"]
-        delimiters.extend(string.whitespace)
+# Frozensets so that the char-by-char membership
+# tests in the parser are O(1) and the sets aren't
+# rebuilt for every symbol.
+_symbol_delimiters = frozenset("()" + string.whitespace)
+_whitespace_chars = frozenset(string.whitespace)
+
+# The same string literal often appears many times
+# (think map keys, or one used inside a fn body).
+# Share a single StringVar per unique literal.
+_string_literals = {}
 
-    symbol = ""
-    while idx < len(src) and src[idx] not in delimiters:
-        symbol += src[idx]
-        idx += 1
 
-    if is_string:
+def get_symbol(src, idx):
+    if src[idx] == "\"":
+        # Jump straight to the closing quote,
+        # one C level scan for the whole literal.
+        idx += 1
+        end = src.find("\"", idx)
+        if end == -1:
+            end = len(src)
+        symbol = src[idx:end]
+        idx = end + 1
+
+        interned = _string_literals.get(symbol)
+        if interned is None:
+            interned = _string_literals[symbol] = StringVar(symbol)
+        return interned, idx
+
+    # Scan to the end then slice, rather than building
+    # the symbol up one char at a time.
+    start = idx
+    while idx < len(src) and src[idx] not in _symbol_delimiters:
         idx += 1
-        symbol = StringVar(symbol)
 
-    return symbol, idx
+    return src[start:idx], idx
 
 
 def process_call(src, idx, global_scope):
@@ -170,49 +251,85 @@ def process_call(src, idx, global_scope):
         raise ParsingError("Call must begin with \"(\".")
 
     idx += 1
-    parts = []
+    # One parts list per open bracket, instead of a
+    # recursive call per bracket. Nesting depth is then
+    # not limited by Python's own stack.
+    stack = [[]]
 
     while idx < len(src):
-        if src[idx] == "(":
-            call, idx, global_scope = process_call(src, idx, global_scope)
-            parts.append(call)
-        elif src[idx] == ")":
+        char = src[idx]
+        if char == "(":
+            stack.append([])
+            idx += 1
+        elif char == ")":
+            parts = stack.pop()
+            call = make_call(parts[0], parts[1:], global_scope)
             # Note the +1 here to consume the closing bracket
-            return make_call(
-                parts[0], parts[1:], global_scope), idx+1, global_scope
-        elif src[idx] in string.whitespace:
+            idx += 1
+            if not stack:
+                return call, idx, global_scope
+            stack[-1].append(call)
+        elif char in _whitespace_chars:
             # Whitespace around () will have been removed but
             # it is still in between arguments
             idx += 1
         else:
             symbol, idx = get_symbol(src, idx)
-            parts.append(symbol)
+            stack[-1].append(symbol)
 
+    # Innermost unfinished call, same as the old
+    # recursive version reported
+    parts = stack[-1]
     if parts:
         raise ParsingError(
             "Unterminated call to function \"{}\"".format(parts[0]))
 
 
+# Comments run to the end of the line and may contain
+# brackets, so they get their own pass. Folding them
+# into the bracket pattern below lets the regex engine
+# backtrack to a "(" *inside* a comment and treat it as
+# a real bracket.
+_comment = re.compile(r"#[^\n]*")
+
+# One pattern for the whitespace handling: a run around
+# a bracket is eaten with the bracket, any other run
+# collapses to a single space.
+_normalise = re.compile(r"\s*([\(\)])\s*|\s+")
+
+
+# Memoised because the same source gets normalised
+# repeatedly: library files per import, and the flask
+# app re-runs whatever is in the editor.
+@lru_cache(maxsize=256)
 def normalise(source):
     # TODO: you can't use # in a string, or ( )
     # this needs to be more context aware
+    source = _comment.sub("", source)
+    end = len(source)
+
+    def replace(match):
+        bracket = match.group(1)
+        if bracket:
+            # <space><bracket><space> => <bracket>
+            return bracket
+        if match.start() == 0 or match.end() == end:
+            # Nothing to separate at the ends of the source
+            return ""
+        # <space> n times => <space>
+        return " "
 
-    # <space><bracket><space> => <bracket>
-    return re.sub(r"\s*([\(\)])\s*", r"\g<1>",
-                  # <space> n times => <space>
-                  re.sub(r"\s+", " ",
-                         # remove comments
-                         re.sub(r"#.*(\n)?", "", source)))
+    return _normalise.sub(replace, source)
 
 
 # Call this one when you want to get the resulting global scope
 def run_source_inner(source, global_scope=None):
     if global_scope is None:
-        """ No need for a deep copy here,
-            the Classes will stay the same.
-            Just don't want other fns hanging
-            around between runs. """
-        global_scope = copy(builtin_calls)
+        """ Layer a fresh dict over the builtins rather
+            than copying them. defuns land in the front
+            dict, so other fns still don't hang around
+            between runs. """
+        global_scope = ChainMap({}, builtin_calls)
 
     source = normalise(source)
     idx = 0
@@ -77,6 +77,11 @@ def test_normalise():
     '(+ 2 1)'
     >>> normalise("(+ 1 2) #thing\\n(+ 3 4)")
     '(+ 1 2)(+ 3 4)'
+    >>> # Brackets inside a comment are not real brackets
+    >>> normalise("(print 1 # inline (weird) comment\\n2)")
+    '(print 1 2)'
+    >>> normalise("(+ 1 # add (one) and two\\n2)")
+    '(+ 1 2)'
     """
     pass
 
@@ -119,7 +124,7 @@ in "(let 'foo' 2 (+ 'foo' 5))".
     >>> # Show that the body is not evaluated
     >>> execute(
     ...     DefineFunctionCall("'x", "'y", PlusCall("x", "y")), {}, {})
-    <class 'abc.UserCall_x'>
+    <class 'calls.UserCall_x'>
     >>> execute(SquareRootCall(), {}, {})
     Traceback (most recent call last):
     RuntimeError: Expected 1 argument for function "sqrt", got 0.
@@ -152,6 +157,43 @@ def test_flatten_call():
     pass
 
 
+def test_fold_constants():
+    """
+    >>> # Constant subtrees become their result
+    >>> fold_constants(PlusCall("1", PlusCall("2", "3")))
+    6
+    >>> # Partial folds keep the rest of the tree
+    >>> fold_constants(PlusCall("a", PlusCall("2", "3")))
+    (+ 'a' 5)
+    >>> # Nested adds are spliced into their parent
+    >>> fold_constants(PlusCall("a", PlusCall("b", "c")))
+    (+ 'a' 'b' 'c')
+    >>> # Unless their argument count isn't known until
+    >>> # run time, they have to do their own validation
+    >>> fold_constants(PlusCall("1", PlusCall("*ls")))
+    (+ '1' (+ '*ls'))
+    >>> # Calls that would raise are left alone, the
+    >>> # error should happen when (if) the fn is called
+    >>> fold_constants(ModulusCall("1", "0"))
+    (% '1' '0')
+    >>> fold_constants(SquareRootCall(MinusCall("0", "1")))
+    (sqrt -1)
+    >>> # Including bad argument counts
+    >>> fold_constants(SquareRootCall("1", "2"))
+    (sqrt '1' '2')
+    >>> # Folded fn bodies behave as if unfolded
+    >>> run_source("(defun 'f 'x (+ x (- 10 (+ 2 3)))) (f 1)")
+    6
+    >>> run_source("(defun 'f (sqrt (- 0 1))) (f)")
+    Traceback (most recent call last):
+    ValueError: math domain error
+    >>> # The fold happens, the body is one constant here
+    >>> get_execute_count("(defun 'f (+ 1 (+ 2 3))) (f)")
+    2
+    """
+    pass
+
+
 def test_make_call():
     """
     >>> # User function names aren't resolved here
@@ -240,7 +282,7 @@ def test_run_source():
     35
     >>> #No return value from program should be fine
     >>> run_source("(defun 'x (+ 1))")
-    <class 'abc.UserCall_x'>
+    <class 'calls.UserCall_x'>
     >>> # Can have no arguments
     >>> run_source("(defun 'x (+ 4)) (sqrt (x))")
     2.0
@@ -310,7 +352,7 @@ def test_run_source():
     >>> run_source("(if (eq 1 1) (+ 1))")
     1
     >>> run_source("(defun 'f 'a '* (+ a *))")
-    <class 'abc.UserCall_f'>
+    <class 'calls.UserCall_f'>
     >>> run_source("(defun 'g '* 'a (+ a *))")
     Traceback (most recent call last):
     RuntimeError: "'*" must be the last parameter if present.
@@ -361,6 +403,13 @@ def test_run_source():
     ...    (+ *ls)\\
     ...  )")
     3
+    >>> # A * expansion can leave a call with no arguments,
+    >>> # which is still an error inside a fn body
+    >>> run_source(
+    ... "(defun 'f 'ls (+ 1 (+ *ls)))\\
+    ...  (f (flatten \\"\\"))")
+    Traceback (most recent call last):
+    RuntimeError: Expected at least 1 argument for function "+", got 0.
     >>> # Built in functions should also be in the global scope
     >>> run_source(
     ... "(defun 'f 'otherf '* (otherf **))\\